@@ -8,35 +8,41 @@ import os
 import re
 import sys
 import argparse
+import asyncio
 import subprocess
 import tempfile
 import json
 import hashlib
 import time
+import functools
 from pathlib import Path
-from platformdirs import PlatformDirs
 
 
-try:
-    import litellm
-except ImportError:
-    print("Error: litellm package is required. Install with: pip install litellm", file=sys.stderr)
-    sys.exit(1)
-
 try:
     from dotenv import load_dotenv
     _DOTENV_AVAILABLE = True
 except ImportError:
     _DOTENV_AVAILABLE = False
 
+try:
+    import orjson
+    _ORJSON_AVAILABLE = True
+except ImportError:
+    _ORJSON_AVAILABLE = False
 
-PLATFORMDIRS = PlatformDirs(appname="llmexec", appauthor="Eugene-E0a80fd8080ff8e on github")
-local_cache_dir = Path.cwd() / ".llmexec-cache"
-if local_cache_dir.is_dir():
-    cache_dir = local_cache_dir
-else:
-    cache_dir = PLATFORMDIRS.user_cache_dir
-os.makedirs(cache_dir, exist_ok=True)
+
+# Filters used to build readable cache filenames
+_RE_PROMPT_CHARS = re.compile("[-_A-Za-z0-9. ]+")
+_UNDERSCORES = str.maketrans(". ", "__")
+_RE_DOT = re.compile("[.]")
+_RE_NONWORD = re.compile("[^-_A-Za-z0-9]")
+
+# Cache-key hashers already fed with the model name, keyed by model
+_MODEL_HASHERS = {}
+
+# The first code block (closed by another fence or by the end of the response),
+# or a line that already looks like raw Python code without code blocks
+_CODE_BLOCK_RE = re.compile(r"^[^\S\n]*(?:```[^\n]*\n(.*?)(?:^[^\S\n]*```|\Z)|#!/usr/bin/env python|import )", re.S | re.M)
 
 # System prompt for code generation
 SYSTEM_PROMPT = """You are a code generation assistant that creates Python scripts based on natural language requests. Your task is to convert user requests into complete, executable Python programs.
@@ -95,102 +101,266 @@ if __name__ == "__main__":
 Remember: Generate complete, ready-to-run Python scripts that accomplish exactly what the user requested. Only output the Python code, no explanations or markdown formatting."""
 
 
+@functools.lru_cache(maxsize=None)
+def _cache_root():
+    """Pick the cache directory on first use; it is created on the first cache write."""
+    local_cache_dir = Path.cwd() / ".llmexec-cache"
+    if local_cache_dir.is_dir():
+        return local_cache_dir
+    return _user_cache_dir()
+
+
+def _user_cache_dir():
+    """The per-user cache directory from platformdirs (not created here)."""
+    from platformdirs import PlatformDirs
+    platformdirs = PlatformDirs(appname="llmexec", appauthor="Eugene-E0a80fd8080ff8e on github")
+    return Path(platformdirs.user_cache_dir)
+
+
+def script_path_for(python_code):
+    """Return a file holding python_code, named after a hash of the code.
+
+    The file lives in the user cache directory, never in a project-local
+    .llmexec-cache. Since the name fixes the content, an existing file is
+    reused untouched, and a new one only appears once fully written, so
+    concurrent runs never see a partial script. Raises OSError when the
+    directory is not writable.
+    """
+    data = python_code.encode('utf-8')
+    scripts_dir = _user_cache_dir() / "scripts"
+    script_file = scripts_dir / f"{hashlib.blake2b(data, digest_size=8).hexdigest()}.py"
+    if script_file.is_file():
+        return script_file
+
+    scripts_dir.mkdir(parents=True, exist_ok=True)
+    write_atomic(script_file, data)
+    return script_file
+
+
+def write_atomic(path, data):
+    """Write data to path via a temporary file in the same directory.
+
+    Readers see either the old file or the complete new one, never a
+    truncated file, even with several llmexec runs going at once.
+    """
+    fd, temp_file = tempfile.mkstemp(prefix=path.name + '.', suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_file, path)
+    except BaseException:
+        try:
+            os.unlink(temp_file)
+        except OSError:
+            pass
+        raise
+
+
+def _prompt_stem(prompt, maxlen=30):
+    """Filename-safe prefix of the prompt, with '.' and ' ' turned into '_'.
+
+    Only scans as much of the prompt as it takes to collect maxlen characters.
+    """
+    kept = []
+    size = 0
+    for run in _RE_PROMPT_CHARS.finditer(prompt):
+        kept.append(run.group())
+        size += len(kept[-1])
+        if size >= maxlen:
+            break
+    return "".join(kept)[:maxlen].translate(_UNDERSCORES)
+
+
+@functools.lru_cache(maxsize=128)
 def get_cache_path(model, prompt):
-    """Generate a unique cache file path based on model and prompt."""
+    """Generate a unique cache file path based on model and prompt.
+
+    The returned .txt file holds the raw LLM response; a .json file with the
+    same stem keeps the model, prompt and timestamp for reference.
+    """
     # Create a hash of the model and prompt to use as filename
     # This ensures a unique, yet consistent, filename for each query
-    p = re.sub("[. ]","_",prompt)
-    p = re.sub("[^-_A-Za-z0-9]","",p)
-    p = p[:30]
+    p = _prompt_stem(prompt)
+    m = _RE_NONWORD.sub("", _RE_DOT.sub("_", model.rpartition("/")[2]))
+
+    # Only 10 hex digits end up in the filename, so a 5-byte BLAKE2b digest is enough.
+    # The state after hashing the model is kept and copied for each prompt.
+    model_hash = _MODEL_HASHERS.get(model)
+    if model_hash is None:
+        model_hash = hashlib.blake2b(digest_size=5)
+        model_hash.update(model.encode('utf-8'))
+        model_hash.update(b"\0")
+        _MODEL_HASHERS[model] = model_hash
+    h = model_hash.copy()
+    h.update(prompt.encode('utf-8'))
+    return _cache_root() / f"{p}.{m}.{h.hexdigest()}.txt"
+
+
+def dump_json(obj):
+    """Serialize obj to UTF-8 JSON bytes, using orjson when it is installed."""
+    if _ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def read_cache(cache_file, cache_ttl=0, verbose=False):
+    """Return the cached response, or None if there is no valid cache entry."""
+    # A single stat both checks for the entry and gives its age
+    try:
+        st = cache_file.stat()
+    except FileNotFoundError:
+        return None
+
+    # Check if cache is still valid
+    if cache_ttl > 0:
+        file_age = time.time() - st.st_mtime
+        if file_age >= cache_ttl:
+            if verbose:
+                print(f"Cache expired for {cache_file}", file=sys.stderr)
+            cache_file.unlink(missing_ok=True) # Invalidate cache
+            cache_file.with_suffix('.json').unlink(missing_ok=True)
+            return None
+    # cache_ttl == 0 means infinite cache
+
+    # The entry is the raw response, so it is returned without any parsing
+    try:
+        content = cache_file.read_bytes().decode('utf-8')
+    except FileNotFoundError:
+        return None
+    if verbose:
+        print(f"Using cached response from {cache_file}", file=sys.stderr)
+    return content
 
-    m = model[model.rfind("/")+1:]
-    m = re.sub("[.]","_",m)
-    m = re.sub("[^-_A-Za-z0-9]","",m)
 
-    prompt_hash = hashlib.sha256(f"{model}-{prompt}".encode('utf-8')).hexdigest()
-    return Path(cache_dir) / f"{p}.{m}.{prompt_hash[:10]}.json"
+def _import_litellm():
+    """Import litellm on demand; it is slow to import, so cache hits never load it."""
+    try:
+        import litellm
+    except ImportError:
+        raise RuntimeError("litellm package is required. Install with: pip install litellm")
+    # Drop unsupported parameters for certain models
+    litellm.drop_params = True
+    return litellm
+
+
+def _completion_args(model, prompt):
+    """Arguments shared by the sync and async completion calls."""
+    # Set temperature low for more consistent code generation
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.1,
+        max_tokens=4000,
+        stream=True
+    )
 
 
-def generate_code(model, prompt, cache_ttl=0, no_cache=False, verbose=False):
-    """Generate code using LiteLLM with custom caching."""
-    cache_file = get_cache_path(model, prompt)
+def _join_response(parts):
+    """Join streamed deltas, refusing an empty response so it is never cached or run."""
+    content = "".join(parts).strip()
+    if not content:
+        raise RuntimeError("LLM API error: empty response")
+    return content
 
-    if not no_cache and cache_file.exists():
-        # Check if cache is still valid
-        if cache_ttl > 0:
-            file_age = time.time() - cache_file.stat().st_mtime
-            if file_age < cache_ttl:
-                if verbose:
-                    print(f"Using cached response from {cache_file}", file=sys.stderr)
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)['content']
-            else:
-                if verbose:
-                    print(f"Cache expired for {cache_file}", file=sys.stderr)
-                os.remove(cache_file) # Invalidate cache
-        else: # cache_ttl == 0 means infinite cache
-            if verbose:
-                print(f"Using cached response from {cache_file}", file=sys.stderr)
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)['content']
 
+def query_llm(model, prompt):
+    """Send the prompt to the LLM and return the complete response."""
+    litellm = _import_litellm()
     try:
-        # Drop unsupported parameters for certain models
-        litellm.drop_params = True
-        # Set temperature low for more consistent code generation
-        response = litellm.completion(
-            model=model,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1,
-            max_tokens=4000
-        )
-        generated_content = response.choices[0].message.content.strip()
+        response = litellm.completion(**_completion_args(model, prompt))
+        # Collect the chunks as they arrive instead of waiting for the whole completion
+        parts = []
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+    except Exception as e:
+        raise RuntimeError(f"LLM API error: {e}")
+    return _join_response(parts)
 
-        # Save to cache
-        if not no_cache:
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump({'model': model, 'prompt': prompt, 'content': generated_content, 'timestamp': time.time()}, f, indent=4, ensure_ascii=False)
-            if verbose:
-                print(f"Cached response to {cache_file}", file=sys.stderr)
 
-        return generated_content
+async def aquery_llm(model, prompt):
+    """Async counterpart of query_llm."""
+    litellm = _import_litellm()
+    try:
+        response = await litellm.acompletion(**_completion_args(model, prompt))
+        parts = []
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
     except Exception as e:
         raise RuntimeError(f"LLM API error: {e}")
+    return _join_response(parts)
+
+
+async def _query_llm_unless_cached(model, prompt, cache_file, cache_ttl, verbose):
+    """Start the LLM request while the cache is checked; a cache hit cancels it.
+
+    Returns a (response, from_cache) tuple.
+    """
+    llm_task = asyncio.ensure_future(aquery_llm(model, prompt))
+    cached = await asyncio.to_thread(read_cache, cache_file, cache_ttl, verbose)
+    if cached is None:
+        return await llm_task, False
+
+    llm_task.cancel()
+    try:
+        await llm_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    return cached, True
+
+
+def generate_code(model, prompt, cache_ttl=0, no_cache=False, verbose=False, preconnect=False):
+    """Generate code using LiteLLM with custom caching.
+
+    With preconnect, the LLM request is not held back until the cache lookup
+    is done; it runs concurrently and is cancelled if the cache has an answer.
+    """
+    if no_cache:
+        return query_llm(model, prompt)
+
+    cache_file = get_cache_path(model, prompt)
+    if preconnect:
+        generated_content, from_cache = asyncio.run(
+            _query_llm_unless_cached(model, prompt, cache_file, cache_ttl, verbose))
+        if from_cache:
+            return generated_content
+    else:
+        cached = read_cache(cache_file, cache_ttl, verbose)
+        if cached is not None:
+            return cached
+        generated_content = query_llm(model, prompt)
+
+    # Save to cache
+    # The response is stored as-is; the .json sidecar is only there for humans
+    # Written atomically so that a concurrent run never reads a half-written entry
+    try:
+        write_atomic(cache_file, generated_content.encode('utf-8'))
+    except FileNotFoundError:
+        # First write to the user cache directory
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(cache_file, generated_content.encode('utf-8'))
+    write_atomic(cache_file.with_suffix('.json'), dump_json({'model': model, 'prompt': prompt, 'timestamp': time.time()}))
+    if verbose:
+        print(f"Cached response to {cache_file}", file=sys.stderr)
+
+    return generated_content
 
 
 def extract_python_code(response):
     """Extract Python code from LLM response, handling various formats"""
-    lines = response.split('\n')
-    
-    # Look for code block markers
-    in_code_block = False
-    code_lines = []
-    
-    for line in lines:
-        if line.strip().startswith('```'):
-            if in_code_block:
-                break
-            else:
-                in_code_block = True
-                continue
-        
-        if in_code_block:
-            code_lines.append(line)
-        elif line.strip().startswith('#!/usr/bin/env python') or line.strip().startswith('import '):
-            # Looks like raw Python code without code blocks
-            code_lines = lines
-            break
-    
-    code = '\n'.join(code_lines).strip()
-    
+    if '```' not in response:
+        return response.strip()
+
+    # group(1) is None when raw Python code shows up before any code block
+    m = _CODE_BLOCK_RE.search(response)
+    code = m.group(1).strip() if m and m.group(1) is not None else ''
+
     # If no code found, return the entire response (might be raw Python)
-    if not code:
-        code = response.strip()
-    
-    return code
+    return code or response.strip()
 
 
 def main():
@@ -230,6 +400,7 @@ Environment variables for API keys:
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     parser.add_argument("--cache-ttl", type=int, default=0, help="Cache time-to-live in seconds (0 for infinite, -1 to disable caching for this call)")
     parser.add_argument("--no-cache", action="store_true", help="Disable caching for this call")
+    parser.add_argument("--preconnect", action="store_true", help="Start the LLM request while the cache is being checked; a cache hit cancels it")
     
     args = parser.parse_args()
     
@@ -249,9 +420,8 @@ Environment variables for API keys:
             print(f"'{args.script}' is not a file. Interpreting as direct message.", file=sys.stderr)
     
     # Skip shebang line if present
-    lines = content.split('\n')
-    if lines[0].startswith('#!'):
-        content = '\n'.join(lines[1:]).strip()
+    if content.startswith('#!'):
+        content = content.partition('\n')[2].strip()
     
     if not content:
         print("Error: Empty script content", file=sys.stderr)
@@ -262,14 +432,17 @@ Environment variables for API keys:
         print(f"Request: {content}")
         print("-" * 50)
     
+    no_cache = args.no_cache or args.cache_ttl == -1
+
     # Generate code using LLM
     try:
         response = generate_code(
             args.model,
             content,
             cache_ttl=args.cache_ttl,
-            no_cache=args.no_cache or args.cache_ttl == -1,
-            verbose=args.verbose
+            no_cache=no_cache,
+            verbose=args.verbose,
+            preconnect=args.preconnect
         )
         python_code = extract_python_code(response)
         
@@ -295,28 +468,48 @@ Environment variables for API keys:
                 print("\nExecuting generated code:")
                 print("-" * 50)
             
-            # Create temporary file and execute
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as f:
-                f.write(python_code)
-                temp_file = f.name
-            
-            try:
-                if content != args.script:
-                    # Change to the directory of the original script
-                    script_dir = os.path.dirname(os.path.abspath(args.script))
+            script_file = temp_file = None
+            if not no_cache:
+                try:
+                    script_file = str(script_path_for(python_code))
+                except OSError:
+                    # Cache directory not writable; use a temporary file instead
+                    pass
+            if script_file is None:
+                with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as f:
+                    f.write(python_code)
+                    script_file = temp_file = f.name
+            argv = [sys.executable, script_file]
+
+            if content != args.script:
+                # Change to the directory of the original script
+                script_dir = os.path.dirname(os.path.abspath(args.script))
+                if script_dir != os.getcwd():
                     os.chdir(script_dir)
-                
+
+            if temp_file is None and sys.platform != 'win32':
+                # Replace this process with the generated code instead of keeping it alive as a parent.
+                # Only done for the content-addressed script: it is never rewritten in place and
+                # needs no cleanup, whereas a temporary file has to be removed once the run ends.
+                sys.stdout.flush()
+                sys.stderr.flush()
+                try:
+                    os.execv(sys.executable, argv)
+                except OSError as e:
+                    if args.verbose:
+                        print(f"exec failed ({e}), running as a subprocess instead", file=sys.stderr)
+
+            try:
                 # Execute the generated Python code
-                result = subprocess.run([sys.executable, temp_file], 
-                                      capture_output=False, 
-                                      text=True)
+                result = subprocess.run(argv)
                 sys.exit(result.returncode)
             finally:
-                # Clean up temporary file
-                try:
-                    os.unlink(temp_file)
-                except:
-                    pass
+                if temp_file is not None:
+                    # Clean up temporary file
+                    try:
+                        os.unlink(temp_file)
+                    except OSError:
+                        pass
     
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)